@@ -0,0 +1,67 @@
+import os
+import pathlib
+import sys
+import duckdb
+
+# Orden físico de `estaciones`: por mes y estación, para que los zone maps de
+# DuckDB (min/max por row group) descarten bloques tanto en consultas por
+# estación como en rangos de fechas de la ciudad.
+ESTACIONES_ORDER_BY = "date_trunc('month', fecha), idestacion, fecha, hora"
+
+def cluster_estaciones(db_path: pathlib.Path) -> None:
+    """
+    Reescribe la BD en un fichero nuevo con `estaciones` ordenada y lo cambia
+    por el original de forma atómica. COPY FROM DATABASE (SCHEMA) recrea
+    esquemas, tablas, vistas, índices y macros; después se copian los datos.
+    Ordenar in situ (DELETE + INSERT) dejaría los bloques antiguos como espacio
+    libre dentro del fichero que se sube a R2 y se descarga en cada arranque.
+    Se ejecuta offline, antes de la subida, no en el arranque del backend.
+    """
+    print(f"[cluster_db] Sorting estaciones in {db_path}")
+    tmp_path = db_path.with_name(db_path.name + ".sorting")
+    tmp_path.unlink(missing_ok=True)
+
+    try:
+        con = duckdb.connect()
+        try:
+            con.execute(f"ATTACH '{db_path}' AS src (READ_ONLY)")
+            con.execute(f"ATTACH '{tmp_path}' AS dst")
+            con.execute("COPY FROM DATABASE src TO dst (SCHEMA)")
+
+            tables = con.execute("""
+                SELECT schema_name, table_name
+                FROM duckdb_tables()
+                WHERE database_name = 'src' AND NOT internal
+            """).fetchall()
+            for schema, table in tables:
+                name = f'"{schema}"."{table}"'
+                order_by = ""
+                if (schema, table) == ("main", "estaciones"):
+                    order_by = f" ORDER BY {ESTACIONES_ORDER_BY}"
+                con.execute(f"INSERT INTO dst.{name} SELECT * FROM src.{name}{order_by}")
+
+            con.execute("DETACH dst")
+            con.execute("DETACH src")
+        finally:
+            con.close()
+        os.replace(tmp_path, db_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    print(f"[cluster_db] Done: {db_path} ({db_path.stat().st_size} bytes)")
+
+def main() -> None:
+    # Uso: python cluster_db.py [ruta.duckdb]  (por defecto DUCKDB_PATH)
+    if len(sys.argv) > 1:
+        db_path = pathlib.Path(sys.argv[1])
+    else:
+        db_path = pathlib.Path(os.getenv("DUCKDB_PATH", "/app/data/bicimad.duckdb"))
+
+    if not db_path.exists():
+        raise RuntimeError(f"[cluster_db] DB not found at {db_path}")
+
+    cluster_estaciones(db_path)
+
+if __name__ == "__main__":
+    main()
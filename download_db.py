@@ -1,6 +1,7 @@
 import os
 import pathlib
 import boto3
+from boto3.s3.transfer import TransferConfig
 
 def must_env(name: str) -> str:
     val = os.getenv(name)
@@ -8,6 +9,18 @@ def must_env(name: str) -> str:
         raise RuntimeError(f"Missing required env var: {name}")
     return val
 
+def warm_page_cache(db_path: pathlib.Path) -> None:
+    """
+    Lee el fichero entero de forma secuencial para dejarlo en la page cache
+    del SO, y así las primeras consultas no pagan lecturas aleatorias en frío.
+    """
+    print(f"[download_db] Warming page cache for {db_path}")
+    with open(db_path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while f.read(1 << 20):
+            pass
+
 def main() -> None:
     # Dónde guardar el fichero en el contenedor
     db_path = pathlib.Path(os.getenv("DUCKDB_PATH", "/app/data/bicimad.duckdb"))
@@ -16,6 +29,7 @@ def main() -> None:
     # Si ya existe y pesa > 0, no descargamos de nuevo
     if db_path.exists() and db_path.stat().st_size > 0:
         print(f"[download_db] DB already exists at {db_path} ({db_path.stat().st_size} bytes)")
+        warm_page_cache(db_path)
         return
 
     endpoint = must_env("S3_ENDPOINT")
@@ -34,12 +48,24 @@ def main() -> None:
         region_name=os.getenv("S3_REGION", "auto"),
     )
 
-    s3.download_file(bucket, key, str(db_path))
+    # Descarga multipart en paralelo: trozos grandes y más hilos para
+    # aprovechar el ancho de banda con ficheros de varios cientos de MB
+    transfer_config = TransferConfig(
+        multipart_threshold=16 * 1024 * 1024,
+        multipart_chunksize=64 * 1024 * 1024,
+        max_concurrency=int(os.getenv("S3_CONCURRENCY", "16")),
+        io_chunksize=1024 * 1024,
+        use_threads=True,
+    )
+
+    s3.download_file(bucket, key, str(db_path), Config=transfer_config)
 
     if not db_path.exists() or db_path.stat().st_size == 0:
         raise RuntimeError("[download_db] Download finished but file is missing/empty")
 
     print(f"[download_db] Download completed: {db_path} ({db_path.stat().st_size} bytes)")
 
+    warm_page_cache(db_path)
+
 if __name__ == "__main__":
     main()
@@ -1,31 +1,368 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date
+import functools
 import io
+import itertools
+import queue
+import tempfile
+import threading
+import time
 
 import duckdb
-import pandas as pd
-from fastapi import FastAPI, Query
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from typing import Optional
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+import pyarrow as pa
+import pyarrow.compute as pc
+import xlsxwriter
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Any, Dict, List, Optional
+
+# Los endpoints de datos devuelven ya un ORJSONResponse (ver _call_and_render),
+# así FastAPI no pasa el resultado por jsonable_encoder y orjson serializa
+# fechas y datetimes de forma nativa.
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# ---------------------------------------------------------
+#  CORS
+# ---------------------------------------------------------
+# API pública de solo lectura sin cookies/credenciales: las cabeceras CORS
+# son siempre las mismas, así que se precalculan en lugar de usar
+# CORSMiddleware (que evalúa el origen en cada petición).
+_CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+_CORS_PREFLIGHT_HEADERS = _CORS_HEADERS + [
+    (b"access-control-allow-methods", b"*"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-max-age", b"600"),
+]
+
+
+class StaticCORSMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Preflight: ningún endpoint atiende OPTIONS, respondemos directamente
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 204, "headers": _CORS_PREFLIGHT_HEADERS})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + _CORS_HEADERS
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+app.add_middleware(StaticCORSMiddleware)
+
+# Las respuestas JSON (claves repetidas, enteros pequeños) comprimen muy bien.
+# El xlsx ya es un zip y los streams Arrow se consumen por lotes: comprimirlos
+# solo gasta CPU y retiene los lotes en el buffer de gzip.
+_GZIP_SKIP_PATHS = {"/api/estacion_rango_xlsx"}
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+class SelectiveGZipMiddleware:
+    def __init__(self, app, **gzip_options):
+        self.app = app
+        self.gzip_app = GZipMiddleware(app, **gzip_options)
 
-MIN_OVERFLOW_DATE_STR = "2024-07-01"  # Changed from 2023-01-01
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            accept = dict(scope["headers"]).get(b"accept", b"").decode("latin-1")
+            if scope["path"] in _GZIP_SKIP_PATHS or ARROW_STREAM_MEDIA_TYPE in accept:
+                await self.app(scope, receive, send)
+                return
+        await self.gzip_app(scope, receive, send)
+
+
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024, compresslevel=5)
+
+MIN_OVERFLOW_DATE = date(2024, 7, 1)  # Changed from 2023-01-01
 
 
 import os
 
 DB_PATH = os.getenv("DUCKDB_PATH", "./data/bicimad.duckdb")
 
-con = duckdb.connect(DB_PATH, read_only=True)
+# La BD en disco se adjunta en solo lectura a una BD en memoria: las tablas
+# originales se exponen como vistas (mismos nombres que antes) y las tablas
+# pre-agregadas se pueden crear en memoria, visibles para todos los cursores.
+# Hilos y memoria fijados explícitamente: dentro de un contenedor DuckDB
+# detecta los recursos del host, no los límites del cgroup.
+DUCKDB_CONFIG = {
+    "threads": int(os.getenv("DUCKDB_THREADS", "4")),
+    "memory_limit": os.getenv("DUCKDB_MEM", "2GB"),
+    "temp_directory": os.getenv("DUCKDB_TEMP_DIR", "/tmp/duckdb"),
+    "enable_object_cache": True,
+}
+con = duckdb.connect(config=DUCKDB_CONFIG)
+con.execute(f"ATTACH '{DB_PATH}' AS bicimad (READ_ONLY)")
+for _table in ("estaciones", "HistEstaciones"):
+    con.execute(f"CREATE VIEW {_table} AS SELECT * FROM bicimad.{_table}")
+
+# Metadatos (lat/long/nombre) por estación, según su registro más reciente
+# en HistEstaciones. Los endpoints hacen un equijoin con esta tabla pequeña
+# en lugar del join por rango de fechas contra HistEstaciones.
+con.execute("""
+    CREATE TABLE estaciones_meta AS
+    SELECT
+        idestacion,
+        MAX_BY(latitud, fin)      AS latitud,
+        MAX_BY(longitud, fin)     AS longitud,
+        MAX_BY(denominacion, fin) AS denominacion
+    FROM HistEstaciones
+    GROUP BY idestacion
+""")
+# Copia en Python para el endpoint /api/estacion, que añade los metadatos
+# a las filas sin hacer join.
+STATION_META = {
+    str(r["idestacion"]): {"latitud": r["latitud"], "longitud": r["longitud"], "denominacion": r["denominacion"]}
+    for r in con.execute("SELECT * FROM estaciones_meta").fetch_arrow_table().to_pylist()
+}
+
+# ---------------------------------------------------------
+#  TABLAS PRE-AGREGADAS (overflow desde MIN_OVERFLOW_DATE)
+# ---------------------------------------------------------
+# Los resúmenes y patrones se calculan una vez al arrancar y los endpoints
+# consultan estas tablas (O(grupos)) en lugar de recorrer `estaciones`.
+# Se guardan suma y nº de valores no nulos para poder recombinar medias.
+# Los SUM y COUNT_IF de conteos se convierten a BIGINT: DuckDB los devuelve como HUGEINT,
+# que por Arrow llega a Python como Decimal y orjson no serializa.
+con.execute("""
+    CREATE TABLE agg_hora AS
+    SELECT
+        e.idestacion,
+        EXTRACT(YEAR  FROM e.fecha) AS year,
+        EXTRACT(MONTH FROM e.fecha) AS month,
+        e.hora,
+        SUM(e.overflow)   AS sum_overflow,
+        COUNT(e.overflow) AS n_overflow,
+        MAX(e.overflow)   AS max_overflow,
+        COUNT_IF(e.overflow > 0)::BIGINT AS hours_with_overflow,
+        COUNT(*)          AS total_hours
+    FROM estaciones e
+    WHERE e.fecha >= ?
+    GROUP BY e.idestacion, year, month, e.hora
+""", [MIN_OVERFLOW_DATE])
+con.execute("""
+    CREATE TABLE agg_mes AS
+    SELECT
+        idestacion,
+        year,
+        month,
+        SUM(sum_overflow)        AS sum_overflow,
+        SUM(n_overflow)::BIGINT          AS n_overflow,
+        MAX(max_overflow)                AS max_overflow,
+        SUM(hours_with_overflow)::BIGINT AS hours_with_overflow,
+        SUM(total_hours)::BIGINT         AS total_hours
+    FROM agg_hora
+    GROUP BY idestacion, year, month
+""")
+con.execute("""
+    CREATE TABLE agg_dia_semana AS
+    SELECT
+        e.idestacion,
+        EXTRACT(YEAR FROM e.fecha) AS year,
+        DAYOFWEEK(e.fecha)         AS day_of_week,
+        SUM(e.overflow)   AS sum_overflow,
+        COUNT(e.overflow) AS n_overflow,
+        MAX(e.overflow)   AS max_overflow,
+        COUNT(*)          AS total_observations
+    FROM estaciones e
+    WHERE e.fecha >= ?
+    GROUP BY e.idestacion, year, day_of_week
+""", [MIN_OVERFLOW_DATE])
+
+# ---------------------------------------------------------
+#  POOL DE CURSORES
+# ---------------------------------------------------------
+# Cada con.cursor() es un contexto de ejecución independiente que comparte
+# catálogo y buffer pool con `con`; así las peticiones concurrentes no se
+# serializan sobre una única conexión. Los streams Arrow usan cursores
+# propios fuera de este pool (ver _arrow_stream_response).
+_DUCKDB_THREADS = int(con.execute("SELECT current_setting('threads')").fetchone()[0])
+DUCKDB_POOL_SIZE = int(os.getenv("DUCKDB_POOL", min(_DUCKDB_THREADS, os.cpu_count() or 1)))
+
+_CURSOR_POOL = queue.LifoQueue()
+for _ in range(DUCKDB_POOL_SIZE):
+    _CURSOR_POOL.put(con.cursor())
+
+
+@contextmanager
+def _get_cursor():
+    cur = _CURSOR_POOL.get()
+    try:
+        yield cur
+    finally:
+        _CURSOR_POOL.put(cur)
+
+
+# ---------------------------------------------------------
+#  EJECUCIÓN DE ENDPOINTS FUERA DEL EVENT LOOP
+# ---------------------------------------------------------
+# Los endpoints son async y delegan la consulta (y la serialización JSON)
+# a un pool de hilos del mismo tamaño que el pool de cursores, de modo que
+# el event loop queda libre para enviar respuestas mientras DuckDB trabaja.
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=DUCKDB_POOL_SIZE, thread_name_prefix="duckdb")
+
+
+def _call_and_render(func, args, kwargs) -> Response:
+    result = func(*args, **kwargs)
+    if isinstance(result, Response):
+        return result
+    rendered = ORJSONResponse(result)
+    # cabeceras puestas por el endpoint en el `response: Response` inyectado
+    sub_response = kwargs.get("response")
+    if sub_response is not None:
+        rendered.headers.update(sub_response.headers)
+    return rendered
+
+
+def _in_query_executor(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            QUERY_EXECUTOR, functools.partial(_call_and_render, func, args, kwargs)
+        )
+
+    return wrapper
+
+# ---------------------------------------------------------
+#  RESPUESTAS ARROW IPC (para clientes que no necesitan JSON)
+# ---------------------------------------------------------
+ARROW_ROWS_PER_BATCH = 50_000
+
+
+def _wants_arrow(request: Request) -> bool:
+    return ARROW_STREAM_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _arrow_stream_response(sql: str, params: list, transform=None) -> StreamingResponse:
+    """
+    Ejecuta la consulta y devuelve el resultado como stream Arrow IPC,
+    enviando cada lote según sale de DuckDB (sin pasar por dicts/JSON).
+    Usa un cursor propio (fuera del pool) porque el resultado se consume
+    después de que el endpoint haya devuelto la respuesta; por eso los streams
+    Arrow no están limitados por DUCKDB_POOL_SIZE (solo por el pool de hilos
+    del servidor), aunque comparten los hilos y la memoria de DuckDB.
+    `transform`, si se indica, se aplica a cada lote (p.ej. columnas calculadas).
+    """
+    cur = con.cursor()
+    try:
+        reader = cur.execute(sql, params).fetch_record_batch(ARROW_ROWS_PER_BATCH)
+        schema = reader.schema
+        if transform is not None:
+            schema = transform(schema.empty_table()).schema
+    except Exception:
+        cur.close()
+        raise
+
+    def gen():
+        buf = io.BytesIO()
+
+        def drain() -> bytes:
+            data = buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+            return data
+
+        try:
+            writer = pa.ipc.new_stream(pa.PythonFile(buf, mode="w"), schema)
+            for batch in reader:
+                if transform is not None:
+                    batch = transform(batch)
+                writer.write_batch(batch)
+                yield drain()
+            writer.close()
+            yield drain()
+        finally:
+            cur.close()
+
+    return StreamingResponse(gen(), media_type=ARROW_STREAM_MEDIA_TYPE)
+
+
+def _arrow_table(sql: str, params: Optional[list] = None) -> pa.Table:
+    with _get_cursor() as cur:
+        return cur.execute(sql, params or []).fetch_arrow_table()
+
+
+def _rows_as_dicts(sql: str, params: Optional[list] = None) -> List[Dict[str, Any]]:
+    """
+    Ejecuta la consulta y devuelve las filas como lista de dicts.
+    Los dicts se construyen en Arrow (C++) a partir del resultado columnar,
+    en lugar de con zip/dict fila a fila en Python.
+    """
+    return _arrow_table(sql, params).to_pylist()
+
+
+# ---------------------------------------------------------
+#  CACHÉ DE RESÚMENES
+# ---------------------------------------------------------
+# Los resúmenes salen de las tablas agg_* construidas al arrancar, que no
+# cambian mientras vive el proceso: se guardan en memoria (LRU con TTL).
+SUMMARY_CACHE_TTL_SECONDS = int(os.getenv("SUMMARY_CACHE_TTL", "3600"))
+SUMMARY_CACHE_MAX_ENTRIES = 1024
+SUMMARY_CACHE_CONTROL = f"public, max-age={SUMMARY_CACHE_TTL_SECONDS}"
+# Errores y datos inventados por falta de datos no deben quedarse en cachés
+# intermedias: solo las filas reales (y las demos fijas) llevan SUMMARY_CACHE_CONTROL.
+NO_CACHE_CONTROL = "no-store"
+
+_summary_cache = OrderedDict()
+_summary_cache_lock = threading.Lock()
+
+
+def _cached_rows_as_dicts(sql: str, params: Optional[list] = None) -> List[Dict[str, Any]]:
+    """
+    Igual que _rows_as_dicts, pero reutiliza el resultado de la misma
+    consulta con los mismos parámetros. Las filas devueltas se comparten
+    entre peticiones: no deben modificarse.
+    """
+    key = (sql, tuple(params or ()))
+    now = time.monotonic()
+
+    with _summary_cache_lock:
+        hit = _summary_cache.get(key)
+        if hit is not None and hit[0] > now:
+            _summary_cache.move_to_end(key)
+            return hit[1]
+
+    rows = _rows_as_dicts(sql, params)
+
+    with _summary_cache_lock:
+        _summary_cache[key] = (now + SUMMARY_CACHE_TTL_SECONDS, rows)
+        _summary_cache.move_to_end(key)
+        while len(_summary_cache) > SUMMARY_CACHE_MAX_ENTRIES:
+            _summary_cache.popitem(last=False)
+    return rows
+
+
+def _sql_variants(head: str, filters: List[str], tail: str) -> Dict[tuple, str]:
+    """
+    Precalcula el texto SQL para cada combinación de filtros opcionales
+    (presente/ausente), de modo que cada petición usa un SQL fijo en lugar
+    de construirlo concatenando cadenas.
+    """
+    return {
+        mask: head + "".join(f for f, on in zip(filters, mask) if on) + tail
+        for mask in itertools.product((False, True), repeat=len(filters))
+    }
+
+
+def _present(*values) -> tuple:
+    return tuple(v is not None for v in values)
+
 
 @app.get("/health")
 def health():
@@ -34,14 +371,68 @@ def health():
 # ---------------------------------------------------------
 #  ENDPOINT EXISTENTE: un día concreto (JSON)
 # ---------------------------------------------------------
+ESTACION_SQL = _sql_variants(
+    """
+        SELECT
+            e.idestacion,
+            e.fecha,
+            e.hora,
+            e.fechaHora,
+            e.ancladas,
+            e.baseslibres,
+            e.overflow,
+            e.activa
+        FROM estaciones e
+        WHERE e.idestacion = ?
+    """,
+    [" AND e.fecha = ?::DATE"],
+    " ORDER BY e.fecha, e.hora",
+)
+
+
 @app.get("/api/estacion")
+@_in_query_executor
 def get_estacion(
     idestacion: str = Query(..., description="ID de la estación"),
     fecha: str = Query(None, description="Fecha YYYY-MM-DD (opcional)"),
 ):
     """
     Devuelve TODOS los registros de una estación en un día (todas las horas),
-    unidos con HistEstaciones para obtener lat/long y nombre.
+    con lat/long y nombre de la estación (STATION_META, sin join).
+    """
+    meta = STATION_META.get(idestacion)
+    if meta is None:
+        return []
+
+    sql = ESTACION_SQL[_present(fecha)]
+    params = [v for v in (idestacion, fecha) if v is not None]
+
+    rows = _rows_as_dicts(sql, params)
+    for r in rows:
+        r.update(meta)
+    return rows
+
+
+# ---------------------------------------------------------
+#  EXPORTACIÓN: rango de fechas de una estación (XLSX)
+# ---------------------------------------------------------
+# Filas por lote Arrow: solo un lote está en memoria a la vez mientras se
+# escribe el libro (xlsxwriter en constant_memory vuelca cada fila a disco).
+XLSX_ROWS_PER_BATCH = 50_000
+
+
+@app.get("/api/estacion_rango_xlsx")
+@_in_query_executor
+def get_estacion_rango_xlsx(
+    idestacion: str = Query(..., description="ID de la estación"),
+    start: str = Query(..., description="Fecha inicio YYYY-MM-DD (incluida)"),
+    end: str = Query(..., description="Fecha fin YYYY-MM-DD (incluida)"),
+):
+    """
+    Exporta a Excel todos los registros de una estación entre start y end.
+    El resultado se lee de DuckDB por lotes Arrow y se escribe con xlsxwriter
+    en modo constant_memory, sin pasar por pandas, así que la memoria no
+    crece con el tamaño del rango.
     """
     sql = """
         SELECT
@@ -57,37 +448,52 @@ def get_estacion(
             h.longitud,
             h.denominacion
         FROM estaciones e
-        JOIN HistEstaciones h
+        JOIN estaciones_meta h
           ON e.idestacion = h.idestacion
-         AND e.fechaHora BETWEEN h.inicio AND h.fin
         WHERE e.idestacion = ?
+          AND e.fecha BETWEEN ?::DATE AND ?::DATE
+        ORDER BY e.fecha, e.hora
     """
-    params = [idestacion]
-
-    if fecha is not None:
-        sql += " AND e.fecha = ?::DATE"
-        params.append(fecha)
-
-    sql += " ORDER BY e.fecha, e.hora"
-
-    cur = con.execute(sql, params)
-    rows = cur.fetchall()
-    cols = [d[0] for d in cur.description]
-    records = [dict(zip(cols, row)) for row in rows]
-    return records
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        tmp_path = tmp.name
 
-
-@app.get("/api/overflow/station_timeseries")
-def overflow_station_timeseries(
-    idestacion: str = Query(..., description="ID de la estación"),
-    start: Optional[str] = Query(None, description="YYYY-MM-DD (incluida)"),
-    end: Optional[str] = Query(None, description="YYYY-MM-DD (incluida)"),
-):
-    """
-    Serie temporal de overflow para una estación y rango de fechas.
-    Solo datos desde 2024-07-01.
+    wb = xlsxwriter.Workbook(tmp_path, {"constant_memory": True, "strings_to_numbers": False})
+    ws = wb.add_worksheet("datos")
+    date_fmt = wb.add_format({"num_format": "yyyy-mm-dd"})
+    datetime_fmt = wb.add_format({"num_format": "yyyy-mm-dd h:mm:ss"})
+    try:
+        with _get_cursor() as cur:
+            reader = cur.execute(sql, [idestacion, start, end]).fetch_record_batch(XLSX_ROWS_PER_BATCH)
+            formats = [
+                date_fmt if pa.types.is_date(f.type)
+                else datetime_fmt if pa.types.is_timestamp(f.type)
+                else None
+                for f in reader.schema
+            ]
+            ws.write_row(0, 0, reader.schema.names)
+            r = 1
+            for batch in reader:
+                for row in zip(*[c.to_pylist() for c in batch.columns]):
+                    for c, (value, fmt) in enumerate(zip(row, formats)):
+                        ws.write(r, c, value, fmt)
+                    r += 1
+        wb.close()
+    except Exception:
+        wb.close()
+        os.unlink(tmp_path)
+        raise
+
+    filename = f"estacion_{idestacion}_{start}_{end}.xlsx"
+    return FileResponse(
+        tmp_path,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        filename=filename,
+        background=BackgroundTask(os.unlink, tmp_path),
+    )
+
+
+STATION_TIMESERIES_SQL = _sql_variants(
     """
-    sql = f"""
         SELECT
             e.idestacion,
             e.fecha,
@@ -99,29 +505,33 @@ def overflow_station_timeseries(
             e.activa
         FROM estaciones e
         WHERE e.idestacion = ?
-          AND e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
-    """
-    params = [idestacion]
+          AND e.fecha >= ?
+    """,
+    [" AND e.fecha >= ?::DATE", " AND e.fecha <= ?::DATE"],
+    " ORDER BY e.fechaHora",
+)
 
-    if start is not None:
-        sql += " AND e.fecha >= ?::DATE"
-        params.append(start)
-    if end is not None:
-        sql += " AND e.fecha <= ?::DATE"
-        params.append(end)
 
-    sql += " ORDER BY e.fechaHora"
+@app.get("/api/overflow/station_timeseries")
+@_in_query_executor
+def overflow_station_timeseries(
+    request: Request,
+    idestacion: str = Query(..., description="ID de la estación"),
+    start: Optional[str] = Query(None, description="YYYY-MM-DD (incluida)"),
+    end: Optional[str] = Query(None, description="YYYY-MM-DD (incluida)"),
+):
+    """
+    Serie temporal de overflow para una estación y rango de fechas.
+    Solo datos desde 2024-07-01.
+    """
+    sql = STATION_TIMESERIES_SQL[_present(start, end)]
+    params = [idestacion, MIN_OVERFLOW_DATE] + [v for v in (start, end) if v is not None]
 
     try:
-        cur = con.execute(sql, params)
-        rows = cur.fetchall()
-        
-        # Check description AFTER fetchall
-        if cur.description is None or not rows:
-            return []
-        
-        cols = [d[0] for d in cur.description]
-        return [dict(zip(cols, r)) for r in rows]
+        if _wants_arrow(request):
+            return _arrow_stream_response(sql, params)
+
+        return _rows_as_dicts(sql, params)
     except Exception as e:
         print(f"Error in station_timeseries: {e}")
         import traceback
@@ -131,6 +541,7 @@ def overflow_station_timeseries(
 
 # --- SNAPSHOT CIUDAD ---
 @app.get("/api/overflow/city_snapshot")
+@_in_query_executor
 def overflow_city_snapshot(
     fecha: str = Query(..., description="YYYY-MM-DD"),
     hora: int = Query(..., ge=0, le=23, description="Hora 0-23"),
@@ -139,7 +550,7 @@ def overflow_city_snapshot(
     Overflow de TODAS las estaciones en una fecha/hora concreta.
     Solo datos desde 2024-07-01.
     """
-    sql = f"""
+    sql = """
         SELECT
             e.idestacion,
             e.fecha,
@@ -153,28 +564,21 @@ def overflow_city_snapshot(
             h.longitud,
             h.denominacion
         FROM estaciones e
-        JOIN HistEstaciones h
+        JOIN estaciones_meta h
           ON e.idestacion = h.idestacion
-         AND e.fechaHora BETWEEN h.inicio AND h.fin
         WHERE e.fecha = ?::DATE
           AND e.hora  = ?
-          AND e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
+          AND e.fecha >= ?
     """
-    cur = con.execute(sql, [fecha, hora])
-    rows = cur.fetchall()
-
-    # Si por lo que sea DuckDB no devuelve descripción o no hay filas, devolvemos lista vacía
-    if cur.description is None or not rows:
-        return []
-
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+    return _rows_as_dicts(sql, [fecha, hora, MIN_OVERFLOW_DATE])
 
 
 
 # --- RANGO CIUDAD (SEMANA) ---
 @app.get("/api/overflow/city_range")
+@_in_query_executor
 def overflow_city_range(
+    request: Request,
     start: str = Query(..., description="Fecha inicio YYYY-MM-DD (incluida)"),
     end: str = Query(..., description="Fecha fin YYYY-MM-DD (incluida, máx ~7 días)"),
 ):
@@ -182,7 +586,7 @@ def overflow_city_range(
     Overflow de TODAS las estaciones entre start y end.
     Solo datos desde 2024-07-01.
     """
-    sql = f"""
+    sql = """
         SELECT
             e.idestacion,
             e.fecha,
@@ -196,23 +600,137 @@ def overflow_city_range(
             h.longitud,
             h.denominacion
         FROM estaciones e
-        JOIN HistEstaciones h
+        JOIN estaciones_meta h
           ON e.idestacion = h.idestacion
-         AND e.fechaHora BETWEEN h.inicio AND h.fin
         WHERE e.fecha BETWEEN ?::DATE AND ?::DATE
-          AND e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
+          AND e.fecha >= ?
         ORDER BY e.fechaHora, e.idestacion
     """
-    cur = con.execute(sql, [start, end])
-    rows = cur.fetchall()
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+    if _wants_arrow(request):
+        return _arrow_stream_response(sql, [start, end, MIN_OVERFLOW_DATE])
+
+    return _rows_as_dicts(sql, [start, end, MIN_OVERFLOW_DATE])
+
+
+# ---------------------------------------------------------
+#  DATOS DEMO (estación 129 y vistas globales sin datos)
+# ---------------------------------------------------------
+# Constantes de módulo: se construyen una vez y se devuelven tal cual.
+_DEMO_129_MONTHLY = (
+    # Ejemplo: solo unos meses de 2024 (si el front filtra por año >= 2024, encaja perfecto)
+    {"idestacion": "129", "year": 2024, "month": 7,
+     "avg_overflow": 5.0, "max_overflow": 20,
+     "hours_with_overflow": 80, "total_hours": 31 * 24},
+    {"idestacion": "129", "year": 2024, "month": 8,
+     "avg_overflow": 6.2, "max_overflow": 25,
+     "hours_with_overflow": 90, "total_hours": 31 * 24},
+    {"idestacion": "129", "year": 2024, "month": 9,
+     "avg_overflow": 8.1, "max_overflow": 42,
+     "hours_with_overflow": 110, "total_hours": 30 * 24},
+)
+
+_DEMO_129_YEARLY = (
+    {
+        "idestacion": "129",
+        "year": 2024,
+        "avg_overflow": 7.5,
+        "max_overflow": 42,
+        "hours_with_overflow": 350,
+        "total_hours": 24 * 120,  # por ejemplo 120 días
+    },
+)
+
+_DEMO_CITY_YEARLY = (
+    {"year": 2024, "avg_overflow": 3.7, "max_overflow": 28,
+     "hours_with_overflow": 2200, "total_hours": 24 * 180},
+)
+
+
+def _demo_129_hourly():
+    fake = []
+    for h in range(24):
+        if 7 <= h <= 9:
+            avg = 6 + (h - 7) * 1.5   # pico mañana
+        elif 17 <= h <= 19:
+            avg = 7 + (h - 17) * 1.2  # pico tarde
+        else:
+            avg = 1.5 if 10 <= h <= 16 else 0.5
+        fake.append({
+            "hora": h,
+            "avg_overflow": round(avg, 2),
+            "max_overflow": int(avg * 3),
+            "total_observations": 200
+        })
+    return tuple(fake)
+
+
+def _demo_global_hourly():
+    fake = []
+    for h in range(24):
+        if 7 <= h <= 9:
+            avg = 3 + (h - 7) * 0.8
+        elif 17 <= h <= 19:
+            avg = 3.5 + (h - 17) * 0.7
+        else:
+            avg = 1.0 if 10 <= h <= 16 else 0.3
+        fake.append({
+            "hora": h,
+            "avg_overflow": round(avg, 2),
+            "max_overflow": int(avg * 2.5),
+            "total_observations": 500
+        })
+    return tuple(fake)
+
+
+_DEMO_129_HOURLY = _demo_129_hourly()
+_DEMO_GLOBAL_HOURLY = _demo_global_hourly()
+
+# Lunes (2) a domingo (1 ó 7, según cómo lo gestione DuckDB; da igual mientras sea consistente)
+_DEMO_129_WEEKDAY = (
+    {"day_of_week": 2, "avg_overflow": 5.5, "max_overflow": 25, "total_observations": 80},  # Lun
+    {"day_of_week": 3, "avg_overflow": 6.0, "max_overflow": 27, "total_observations": 80},  # Mar
+    {"day_of_week": 4, "avg_overflow": 6.8, "max_overflow": 30, "total_observations": 80},  # Mié
+    {"day_of_week": 5, "avg_overflow": 7.2, "max_overflow": 32, "total_observations": 80},  # Jue
+    {"day_of_week": 6, "avg_overflow": 8.0, "max_overflow": 35, "total_observations": 80},  # Vie
+    {"day_of_week": 7, "avg_overflow": 4.0, "max_overflow": 18, "total_observations": 60},  # Sáb
+    {"day_of_week": 1, "avg_overflow": 3.0, "max_overflow": 15, "total_observations": 60},  # Dom
+)
+
+_DEMO_GLOBAL_WEEKDAY = (
+    {"day_of_week": 2, "avg_overflow": 3.5, "max_overflow": 18, "total_observations": 500},  # Lun
+    {"day_of_week": 3, "avg_overflow": 3.8, "max_overflow": 19, "total_observations": 500},  # Mar
+    {"day_of_week": 4, "avg_overflow": 4.0, "max_overflow": 20, "total_observations": 500},  # Mié
+    {"day_of_week": 5, "avg_overflow": 4.2, "max_overflow": 22, "total_observations": 500},  # Jue
+    {"day_of_week": 6, "avg_overflow": 4.8, "max_overflow": 24, "total_observations": 500},  # Vie
+    {"day_of_week": 7, "avg_overflow": 2.5, "max_overflow": 12, "total_observations": 400},  # Sáb
+    {"day_of_week": 1, "avg_overflow": 2.0, "max_overflow": 10, "total_observations": 400},  # Dom
+)
 
 
+STATION_MONTHLY_SQL = _sql_variants(
+    """
+        SELECT
+            a.idestacion,
+            a.year,
+            a.month,
+            a.sum_overflow / a.n_overflow AS avg_overflow,
+            a.max_overflow,
+            a.hours_with_overflow,
+            a.total_hours
+        FROM agg_mes a
+        WHERE a.idestacion = ?
+    """,
+    [" AND a.year = ?"],
+    """
+        ORDER BY a.year, a.month
+    """,
+)
 
 
 @app.get("/api/overflow/station_monthly_summary")
+@_in_query_executor
 def overflow_station_monthly_summary(
+    response: Response,
     idestacion: str = Query(..., description="ID estación, ej. '201'"),
     year: Optional[int] = Query(None, description="Año opcional, ej. 2024"),
 ):
@@ -221,106 +739,63 @@ def overflow_station_monthly_summary(
     Para la DEMO: datos fijos para la estación 129.
     Si hay errores en DuckDB → devolvemos [].
     """
+    response.headers["Cache-Control"] = NO_CACHE_CONTROL
 
     if idestacion == "129":
         print(">>> DEMO: devolviendo datos TRUCADOS para station_monthly_summary(129)")
-        # Ejemplo: solo unos meses de 2024
-        demo_rows = [
-            {"idestacion": "129", "year": 2024, "month": 7,
-             "avg_overflow": 5.0, "max_overflow": 20,
-             "hours_with_overflow": 80, "total_hours": 31 * 24},
-            {"idestacion": "129", "year": 2024, "month": 8,
-             "avg_overflow": 6.2, "max_overflow": 25,
-             "hours_with_overflow": 90, "total_hours": 31 * 24},
-            {"idestacion": "129", "year": 2024, "month": 9,
-             "avg_overflow": 8.1, "max_overflow": 42,
-             "hours_with_overflow": 110, "total_hours": 30 * 24},
-        ]
-        # si el front filtra por año >= 2024, esto encaja perfecto
-        return demo_rows
-
-    sql = f"""
-        SELECT
-            e.idestacion,
-            EXTRACT(YEAR  FROM e.fecha) AS year,
-            EXTRACT(MONTH FROM e.fecha) AS month,
-            AVG(e.overflow)                        AS avg_overflow,
-            MAX(e.overflow)                        AS max_overflow,
-            SUM(CASE WHEN e.overflow > 0 THEN 1 ELSE 0 END) AS hours_with_overflow,
-            COUNT(*)                               AS total_hours
-        FROM estaciones e
-        WHERE e.idestacion = ?
-          AND e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
-    """
-    params = [idestacion]
+        response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+        return _DEMO_129_MONTHLY
 
-    if year is not None:
-        sql += " AND EXTRACT(YEAR FROM e.fecha) = ?"
-        params.append(year)
-
-    sql += """
-        GROUP BY e.idestacion, year, month
-        ORDER BY year, month
-    """
+    sql = STATION_MONTHLY_SQL[_present(year)]
+    params = [v for v in (idestacion, year) if v is not None]
 
     try:
-        cur = con.execute(sql, params)
-        rows = cur.fetchall()
+        rows = _cached_rows_as_dicts(sql, params)
     except Exception as e:
         print(f"Error in station_monthly_summary({idestacion}): {e}")
         import traceback
         traceback.print_exc()
         return []
 
-    if cur.description is None or not rows:
-        return []
-
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+    response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+    return rows
 
 
 @app.get("/api/overflow/station_yearly_summary")
+@_in_query_executor
 def overflow_station_yearly_summary(
-    idestacion: str = Query(..., description="ID estación, ej. '201'")
+    response: Response,
+    idestacion: str = Query(..., description="ID estación, ej. '201'"),
 ):
     """
     Resumen anual por estación.
     Para la DEMO: si la estación es 129, devolvemos datos fijos.
     Además, si hay cualquier error en DuckDB, devolvemos [] en lugar de 500.
     """
+    response.headers["Cache-Control"] = NO_CACHE_CONTROL
 
     # 🔧 MODO TRUCO DEMO: datos fijos para la estación 129
     if idestacion == "129":
         print(">>> DEMO: devolviendo datos TRUCADOS para station_yearly_summary(129)")
-        return [
-            {
-                "idestacion": "129",
-                "year": 2024,
-                "avg_overflow": 7.5,
-                "max_overflow": 42,
-                "hours_with_overflow": 350,
-                "total_hours": 24 * 120,  # por ejemplo 120 días
-            }
-        ]
-
-    sql = f"""
+        response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+        return _DEMO_129_YEARLY
+
+    sql = """
         SELECT
-            e.idestacion,
-            EXTRACT(YEAR FROM e.fecha) AS year,
-            AVG(e.overflow)            AS avg_overflow,
-            MAX(e.overflow)            AS max_overflow,
-            SUM(CASE WHEN e.overflow > 0 THEN 1 ELSE 0 END) AS hours_with_overflow,
-            COUNT(*)                   AS total_hours
-        FROM estaciones e
-        WHERE e.idestacion = ?
-          AND e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
-        GROUP BY e.idestacion, year
-        ORDER BY year
+            a.idestacion,
+            a.year,
+            SUM(a.sum_overflow) / SUM(a.n_overflow) AS avg_overflow,
+            MAX(a.max_overflow)                     AS max_overflow,
+            SUM(a.hours_with_overflow)::BIGINT      AS hours_with_overflow,
+            SUM(a.total_hours)::BIGINT              AS total_hours
+        FROM agg_mes a
+        WHERE a.idestacion = ?
+        GROUP BY a.idestacion, a.year
+        ORDER BY a.year
     """
 
     try:
-        cur = con.execute(sql, [idestacion])
-        rows = cur.fetchall()
+        rows = _cached_rows_as_dicts(sql, [idestacion])
     except Exception as e:
         print(f"Error in station_yearly_summary({idestacion}): {e}")
         import traceback
@@ -328,86 +803,100 @@ def overflow_station_yearly_summary(
         # ⬇️ MUY IMPORTANTE: no reventar, devolver lista vacía
         return []
 
-    # por seguridad extra
-    if cur.description is None or not rows:
-        return []
-
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+    response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+    return rows
 
 
 # --- RESÚMENES GLOBALES (CIUDAD) ---
-@app.get("/api/overflow/city_monthly_summary")
-def overflow_city_monthly_summary(
-    year: Optional[int] = Query(None, description="Año opcional, ej. 2024")
-):
-    sql = f"""
+CITY_MONTHLY_SQL = _sql_variants(
+    """
         SELECT
-            EXTRACT(YEAR  FROM e.fecha) AS year,
-            EXTRACT(MONTH FROM e.fecha) AS month,
-            AVG(e.overflow) AS avg_overflow,
-            MAX(e.overflow) AS max_overflow,
-            SUM(CASE WHEN e.overflow > 0 THEN 1 ELSE 0 END) AS hours_with_overflow,
-            COUNT(*) AS total_hours
-        FROM estaciones e
-        WHERE e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
+            a.year,
+            a.month,
+            SUM(a.sum_overflow) / SUM(a.n_overflow) AS avg_overflow,
+            MAX(a.max_overflow) AS max_overflow,
+            SUM(a.hours_with_overflow)::BIGINT AS hours_with_overflow,
+            SUM(a.total_hours)::BIGINT AS total_hours
+        FROM agg_mes a
+        WHERE TRUE
+    """,
+    [" AND a.year = ?"],
     """
-    params = []
+        GROUP BY a.year, a.month
+        ORDER BY a.year, a.month
+    """,
+)
 
-    if year is not None:
-        sql += " AND EXTRACT(YEAR FROM e.fecha) = ?"
-        params.append(year)
 
-    sql += """
-        GROUP BY year, month
-        ORDER BY year, month
-    """
-    cur = con.execute(sql, params)
-    rows = cur.fetchall()
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+@app.get("/api/overflow/city_monthly_summary")
+@_in_query_executor
+def overflow_city_monthly_summary(
+    response: Response,
+    year: Optional[int] = Query(None, description="Año opcional, ej. 2024"),
+):
+    sql = CITY_MONTHLY_SQL[_present(year)]
+    params = [v for v in (year,) if v is not None]
+    rows = _cached_rows_as_dicts(sql, params)
+    response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+    return rows
 
 @app.get("/api/overflow/city_yearly_summary")
-def overflow_city_yearly_summary():
+@_in_query_executor
+def overflow_city_yearly_summary(response: Response):
     """
     Resumen anual de overflow para TODAS las estaciones.
     Si la consulta no devuelve nada, devolvemos datos inventados de demo.
     """
-    sql = f"""
+    response.headers["Cache-Control"] = NO_CACHE_CONTROL
+    sql = """
         SELECT
-            EXTRACT(YEAR FROM e.fecha) AS year,
-            AVG(e.overflow) AS avg_overflow,
-            MAX(e.overflow) AS max_overflow,
-            SUM(CASE WHEN e.overflow > 0 THEN 1 ELSE 0 END) AS hours_with_overflow,
-            COUNT(*) AS total_hours
-        FROM estaciones e
-        WHERE e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
-        GROUP BY year
-        ORDER BY year
+            a.year,
+            SUM(a.sum_overflow) / SUM(a.n_overflow) AS avg_overflow,
+            MAX(a.max_overflow) AS max_overflow,
+            SUM(a.hours_with_overflow)::BIGINT AS hours_with_overflow,
+            SUM(a.total_hours)::BIGINT AS total_hours
+        FROM agg_mes a
+        GROUP BY a.year
+        ORDER BY a.year
     """
     try:
-        cur = con.execute(sql)
-        rows = cur.fetchall()
+        rows = _cached_rows_as_dicts(sql)
     except Exception as e:
         print(f"Error in city_yearly_summary: {e}")
         import traceback; traceback.print_exc()
         rows = []
 
-    if (cur.description is None if 'cur' in locals() else True) or not rows:
+    if not rows:
         print(">>> DEMO: city_yearly_summary inventado (no hay datos reales)")
-        demo = [
-            {"year": 2024, "avg_overflow": 3.7, "max_overflow": 28,
-             "hours_with_overflow": 2200, "total_hours": 24 * 180},
-        ]
-        return demo
+        return _DEMO_CITY_YEARLY
 
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+    response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+    return rows
 
 
 # ========== NEW ENDPOINTS FOR ENHANCED OVERFLOW ANALYSIS ==========
+HOURLY_PATTERNS_SQL = _sql_variants(
+    """
+        SELECT
+            a.hora,
+            SUM(a.sum_overflow) / SUM(a.n_overflow) AS avg_overflow,
+            MAX(a.max_overflow) AS max_overflow,
+            SUM(a.total_hours)::BIGINT AS total_observations
+        FROM agg_hora a
+        WHERE TRUE
+    """,
+    [" AND a.idestacion = ?", " AND a.year = ?", " AND a.month = ?"],
+    """
+        GROUP BY a.hora
+        ORDER BY a.hora
+    """,
+)
+
+
 @app.get("/api/overflow/hourly_patterns")
+@_in_query_executor
 def overflow_hourly_patterns(
+    response: Response,
     idestacion: Optional[str] = Query(None, description="ID estación (opcional)"),
     year: Optional[int] = Query(None, description="Año opcional"),
     month: Optional[int] = Query(None, ge=1, le=12, description="Mes opcional"),
@@ -418,92 +907,60 @@ def overflow_hourly_patterns(
     - Si idestacion == '129' -> devolvemos patrón INVENTADO, siempre.
     - Si es vista global (idestacion None) y la base devuelve 0 filas -> devolvemos patrón global inventado.
     """
+    response.headers["Cache-Control"] = NO_CACHE_CONTROL
 
     # 🔧 DEMO: datos inventados para la estación 129
     if idestacion == "129":
         print(">>> DEMO: hourly_patterns TRUCADO para estación 129")
-        fake = []
-        for h in range(24):
-            if 7 <= h <= 9:
-                avg = 6 + (h - 7) * 1.5   # pico mañana
-            elif 17 <= h <= 19:
-                avg = 7 + (h - 17) * 1.2  # pico tarde
-            else:
-                avg = 1.5 if 10 <= h <= 16 else 0.5
-            fake.append({
-                "hora": h,
-                "avg_overflow": round(avg, 2),
-                "max_overflow": int(avg * 3),
-                "total_observations": 200
-            })
-        return fake
-
-    sql = f"""
-        SELECT
-            e.hora,
-            AVG(e.overflow) AS avg_overflow,
-            MAX(e.overflow) AS max_overflow,
-            COUNT(*) AS total_observations
-        FROM estaciones e
-        WHERE e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
-    """
-    params = []
-
-    if idestacion is not None:
-        sql += " AND e.idestacion = ?"
-        params.append(idestacion)
+        response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+        return _DEMO_129_HOURLY
 
-    if year is not None:
-        sql += " AND EXTRACT(YEAR FROM e.fecha) = ?"
-        params.append(year)
-
-    if month is not None:
-        sql += " AND EXTRACT(MONTH FROM e.fecha) = ?"
-        params.append(month)
-
-    sql += """
-        GROUP BY e.hora
-        ORDER BY e.hora
-    """
+    sql = HOURLY_PATTERNS_SQL[_present(idestacion, year, month)]
+    params = [v for v in (idestacion, year, month) if v is not None]
 
     try:
-        cur = con.execute(sql, params)
-        rows = cur.fetchall()
+        rows = _cached_rows_as_dicts(sql, params)
     except Exception as e:
         print(f"Error in hourly_patterns({idestacion}): {e}")
         import traceback; traceback.print_exc()
         rows = []
 
     # Si no hay filas y es vista global, inventamos un patrón decente
-    if (cur.description is None if 'cur' in locals() else True) or not rows:
+    if not rows:
         if idestacion is None:
             print(">>> DEMO: hourly_patterns GLOBAL inventado (no hay datos reales)")
-            fake = []
-            for h in range(24):
-                if 7 <= h <= 9:
-                    avg = 3 + (h - 7) * 0.8
-                elif 17 <= h <= 19:
-                    avg = 3.5 + (h - 17) * 0.7
-                else:
-                    avg = 1.0 if 10 <= h <= 16 else 0.3
-                fake.append({
-                    "hora": h,
-                    "avg_overflow": round(avg, 2),
-                    "max_overflow": int(avg * 2.5),
-                    "total_observations": 500
-                })
-            return fake
+            return _DEMO_GLOBAL_HOURLY
         return []
 
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+    response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+    return rows
+
+
 
 
 
+WEEKDAY_PATTERNS_SQL = _sql_variants(
+    """
+        SELECT
+            a.day_of_week,
+            SUM(a.sum_overflow) / SUM(a.n_overflow) AS avg_overflow,
+            MAX(a.max_overflow) AS max_overflow,
+            SUM(a.total_observations)::BIGINT AS total_observations
+        FROM agg_dia_semana a
+        WHERE TRUE
+    """,
+    [" AND a.idestacion = ?", " AND a.year = ?"],
+    """
+        GROUP BY a.day_of_week
+        ORDER BY a.day_of_week
+    """,
+)
 
 
 @app.get("/api/overflow/weekday_patterns")
+@_in_query_executor
 def overflow_weekday_patterns(
+    response: Response,
     idestacion: Optional[str] = Query(None, description="ID estación (opcional)"),
     year: Optional[int] = Query(None, description="Año opcional"),
 ):
@@ -513,53 +970,23 @@ def overflow_weekday_patterns(
     - Si idestacion == '129' -> devolvemos SIEMPRE datos inventados.
     - Si es global y no hay filas -> devolvemos patrón global inventado.
     """
+    response.headers["Cache-Control"] = NO_CACHE_CONTROL
 
     print(f"weekday_patterns called with idestacion={idestacion}, year={year}")
 
     # 🔧 DEMO: datos inventados para la estación 129
     if idestacion == "129":
         print(">>> DEMO: weekday_patterns TRUCADO para estación 129")
-        # Lunes (2) a domingo (1 ó 7, según cómo lo gestione DuckDB; da igual mientras sea consistente)
-        fake = [
-            {"day_of_week": 2, "avg_overflow": 5.5, "max_overflow": 25, "total_observations": 80},  # Lun
-            {"day_of_week": 3, "avg_overflow": 6.0, "max_overflow": 27, "total_observations": 80},  # Mar
-            {"day_of_week": 4, "avg_overflow": 6.8, "max_overflow": 30, "total_observations": 80},  # Mié
-            {"day_of_week": 5, "avg_overflow": 7.2, "max_overflow": 32, "total_observations": 80},  # Jue
-            {"day_of_week": 6, "avg_overflow": 8.0, "max_overflow": 35, "total_observations": 80},  # Vie
-            {"day_of_week": 7, "avg_overflow": 4.0, "max_overflow": 18, "total_observations": 60},  # Sáb
-            {"day_of_week": 1, "avg_overflow": 3.0, "max_overflow": 15, "total_observations": 60},  # Dom
-        ]
-        return fake
-
-    sql = f"""
-        SELECT
-            DAYOFWEEK(e.fecha) AS day_of_week,
-            AVG(e.overflow) AS avg_overflow,
-            MAX(e.overflow) AS max_overflow,
-            COUNT(*) AS total_observations
-        FROM estaciones e
-        WHERE e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
-    """
-    params = []
+        response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+        return _DEMO_129_WEEKDAY
 
-    if idestacion is not None:
-        sql += " AND e.idestacion = ?"
-        params.append(idestacion)
-
-    if year is not None:
-        sql += " AND EXTRACT(YEAR FROM e.fecha) = ?"
-        params.append(year)
-
-    sql += """
-        GROUP BY day_of_week
-        ORDER BY day_of_week
-    """
+    sql = WEEKDAY_PATTERNS_SQL[_present(idestacion, year)]
+    params = [v for v in (idestacion, year) if v is not None]
 
     try:
         print(f"Executing SQL: {sql}")
         print(f"With params: {params}")
-        cur = con.execute(sql, params)
-        rows = cur.fetchall()
+        rows = _cached_rows_as_dicts(sql, params)
         print(f"Got {len(rows)} rows")
     except Exception as e:
         print(f"Error in weekday_patterns: {e}")
@@ -567,75 +994,70 @@ def overflow_weekday_patterns(
         rows = []
 
     # Si no hay datos y es vista global, inventamos patrón bonito
-    if (cur.description is None if 'cur' in locals() else True) or not rows:
+    if not rows:
         if idestacion is None:
             print(">>> DEMO: weekday_patterns GLOBAL inventado (no hay datos reales)")
-            fake = [
-                {"day_of_week": 2, "avg_overflow": 3.5, "max_overflow": 18, "total_observations": 500},  # Lun
-                {"day_of_week": 3, "avg_overflow": 3.8, "max_overflow": 19, "total_observations": 500},  # Mar
-                {"day_of_week": 4, "avg_overflow": 4.0, "max_overflow": 20, "total_observations": 500},  # Mié
-                {"day_of_week": 5, "avg_overflow": 4.2, "max_overflow": 22, "total_observations": 500},  # Jue
-                {"day_of_week": 6, "avg_overflow": 4.8, "max_overflow": 24, "total_observations": 500},  # Vie
-                {"day_of_week": 7, "avg_overflow": 2.5, "max_overflow": 12, "total_observations": 400},  # Sáb
-                {"day_of_week": 1, "avg_overflow": 2.0, "max_overflow": 10, "total_observations": 400},  # Dom
-            ]
-            return fake
+            return _DEMO_GLOBAL_WEEKDAY
         return []
 
-    cols = [d[0] for d in cur.description]
-    result = [dict(zip(cols, r)) for r in rows]
-    print(f"Returning {len(result)} results")
-    return result
+    print(f"Returning {len(rows)} results")
+    response.headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+    return rows
 
 
 
-@app.get("/api/overflow/capacity_analysis")
-def overflow_capacity_analysis(
-    idestacion: str = Query(..., description="ID estación"),
-    start: Optional[str] = Query(None, description="Fecha inicio"),
-    end: Optional[str] = Query(None, description="Fecha fin"),
-):
+CAPACITY_ANALYSIS_SQL = _sql_variants(
     """
-    Análisis de capacidad: relación entre overflow, bicis ancladas y bases libres.
-    """
-    sql = f"""
         SELECT
             e.fecha,
             e.hora,
             e.overflow,
             e.ancladas,
             e.baseslibres,
-            (e.ancladas + e.baseslibres) AS capacidad_total,
-            CASE 
-                WHEN (e.ancladas + e.baseslibres) > 0 
-                THEN CAST(e.ancladas AS FLOAT) / (e.ancladas + e.baseslibres) * 100
-                ELSE 0 
-            END AS ocupacion_pct,
-            CASE 
-                WHEN (e.ancladas + e.baseslibres) > 0 
-                THEN CAST(e.overflow AS FLOAT) / (e.ancladas + e.baseslibres) * 100
-                ELSE 0 
-            END AS overflow_pct_capacidad
+            (e.ancladas + e.baseslibres) AS capacidad_total
         FROM estaciones e
         WHERE e.idestacion = ?
-          AND e.fecha >= DATE '{MIN_OVERFLOW_DATE_STR}'
+          AND e.fecha >= ?
+    """,
+    [" AND e.fecha >= ?::DATE", " AND e.fecha <= ?::DATE"],
+    " ORDER BY e.fecha, e.hora",
+)
+
+
+def _add_capacity_pcts(data):
+    """
+    Añade ocupacion_pct y overflow_pct_capacidad (float32, 0 si no hay
+    capacidad) a una tabla/lote Arrow, con operaciones vectorizadas.
     """
-    params = [idestacion]
+    cap = data["capacidad_total"]
+    has_cap = pc.fill_null(pc.greater(cap, 0), False)
+    safe_cap = pc.cast(pc.if_else(has_cap, cap, 1), pa.float32())
+    hundred = pa.scalar(100, pa.float32())
+    zero = pa.scalar(0, pa.float32())
+    for name, column in (("ocupacion_pct", "ancladas"), ("overflow_pct_capacidad", "overflow")):
+        pct = pc.multiply(pc.divide(pc.cast(data[column], pa.float32()), safe_cap), hundred)
+        data = data.append_column(name, pc.if_else(has_cap, pct, zero))
+    return data
 
-    if start is not None:
-        sql += " AND e.fecha >= ?::DATE"
-        params.append(start)
 
-    if end is not None:
-        sql += " AND e.fecha <= ?::DATE"
-        params.append(end)
+@app.get("/api/overflow/capacity_analysis")
+@_in_query_executor
+def overflow_capacity_analysis(
+    request: Request,
+    idestacion: str = Query(..., description="ID estación"),
+    start: Optional[str] = Query(None, description="Fecha inicio"),
+    end: Optional[str] = Query(None, description="Fecha fin"),
+):
+    """
+    Análisis de capacidad: relación entre overflow, bicis ancladas y bases libres.
+    """
+    sql = CAPACITY_ANALYSIS_SQL[_present(start, end)]
+    params = [idestacion, MIN_OVERFLOW_DATE] + [v for v in (start, end) if v is not None]
 
-    sql += " ORDER BY e.fecha, e.hora"
+    if _wants_arrow(request):
+        return _arrow_stream_response(sql, params, transform=_add_capacity_pcts)
 
-    cur = con.execute(sql, params)
-    rows = cur.fetchall()
-    cols = [d[0] for d in cur.description]
-    return [dict(zip(cols, r)) for r in rows]
+    return _add_capacity_pcts(_arrow_table(sql, params)).to_pylist()
 
 
 """
@@ -645,8 +1067,6 @@ Análisis semanal ENDPOINTS
 # ACTIVA (OPEN/CLOSED) ANALYSIS ENDPOINTS
 # =======================
 
-from typing import List, Dict, Any
-
 def _normalize_status(open_obs: int, closed_obs: int) -> str:
     if open_obs > 0 and closed_obs == 0:
         return "always_open"     # green
@@ -656,6 +1076,7 @@ def _normalize_status(open_obs: int, closed_obs: int) -> str:
 
 
 @app.get("/api/activa/city_summary")
+@_in_query_executor
 def activa_city_summary(
     start: str = Query(..., description="YYYY-MM-DD (incluida)"),
     end: str = Query(..., description="YYYY-MM-DD (incluida)"),
@@ -672,20 +1093,18 @@ def activa_city_summary(
             h.denominacion,
             h.latitud,
             h.longitud,
-            SUM(CASE WHEN COALESCE(CAST(e.activa AS INTEGER), 0) = 1 THEN 1 ELSE 0 END) AS open_obs,
-            SUM(CASE WHEN COALESCE(CAST(e.activa AS INTEGER), 0) = 0 THEN 1 ELSE 0 END) AS closed_obs,
+            COUNT_IF(COALESCE(CAST(e.activa AS INTEGER), 0) = 1)::BIGINT AS open_obs,
+            COUNT_IF(COALESCE(CAST(e.activa AS INTEGER), 0) = 0)::BIGINT AS closed_obs,
             COUNT(*) AS total_obs
         FROM estaciones e
-        JOIN HistEstaciones h
+        JOIN estaciones_meta h
           ON e.idestacion = h.idestacion
-         AND e.fechaHora BETWEEN h.inicio AND h.fin
         WHERE e.fecha BETWEEN ?::DATE AND ?::DATE
         GROUP BY e.idestacion, h.denominacion, h.latitud, h.longitud
         ORDER BY e.idestacion
     """
-    cur = con.execute(sql, [start, end])
-    rows = cur.fetchall()
-    if cur.description is None or not rows:
+    stations = _rows_as_dicts(sql, [start, end])
+    if not stations:
         return {
             "start": start,
             "end": end,
@@ -693,9 +1112,6 @@ def activa_city_summary(
             "stations": [],
         }
 
-    cols = [d[0] for d in cur.description]
-    stations = [dict(zip(cols, r)) for r in rows]
-
     always_open = mixed = always_closed = 0
     for s in stations:
         oo = int(s.get("open_obs") or 0)
@@ -723,6 +1139,7 @@ def activa_city_summary(
 
 
 @app.get("/api/activa/station_status")
+@_in_query_executor
 def activa_station_status(
     idestacion: str = Query(..., description="ID estación"),
     start: str = Query(..., description="YYYY-MM-DD (incluida)"),
@@ -745,16 +1162,14 @@ def activa_station_status(
             h.latitud,
             h.longitud
         FROM estaciones e
-        JOIN HistEstaciones h
+        JOIN estaciones_meta h
           ON e.idestacion = h.idestacion
-         AND e.fechaHora BETWEEN h.inicio AND h.fin
         WHERE e.idestacion = ?
           AND e.fecha BETWEEN ?::DATE AND ?::DATE
         ORDER BY e.fecha, e.hora
     """
-    cur = con.execute(sql, [idestacion, start, end])
-    rows = cur.fetchall()
-    if cur.description is None or not rows:
+    recs = _rows_as_dicts(sql, [idestacion, start, end])
+    if not recs:
         return {
             "idestacion": idestacion,
             "start": start,
@@ -765,9 +1180,6 @@ def activa_station_status(
             "closed_moments": [],
         }
 
-    cols = [d[0] for d in cur.description]
-    recs = [dict(zip(cols, r)) for r in rows]
-
     open_obs = 0
     closed_obs = 0
     closed_moments = []